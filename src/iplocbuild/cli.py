@@ -5,21 +5,34 @@ import os
 import sys
 import pprint
 import json
-import re
 import click
+import orjson
+import radix
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from netaddr import IPSet
 from lxml import etree
 
-from jnpr.junos import Device
-
 pp = pprint.PrettyPrinter(indent=2, width=120)
 
 verbose_level = 0
 cfg = {}
 cities = {}
 
-paSpaceSet = IPSet([])
+# Radix tree of every city's base allocation, node data holds the owning cities.
+# There is only ever one owner once the overlap check in cli() has passed.
+#
+cityTree = radix.Radix()
+
+# Radix tree of our own PA Space.
+#
+paTree = radix.Radix()
+
+# Compiled XPath expressions for the fields read from each route.
+#
+rtDestinationXPath = etree.XPath('string(rt-destination)', smart_strings=False)
+rtPrefixLengthXPath = etree.XPath('string(rt-prefix-length)', smart_strings=False)
+rtASPathXPath = etree.XPath('string(rt-entry/as-path)', smart_strings=False)
 
 
 def ipset_to_list(ipSetFrom):
@@ -31,18 +44,60 @@ def ipset_to_list(ipSetFrom):
     Returns:
         list: List of IP Addresses
     """
-    toList = []
-    for cidr in ipSetFrom.iter_cidrs():
-        toList.append(str(cidr))
+    return [str(cidr) for cidr in ipSetFrom.iter_cidrs()]
+
+
+def get_first_as(aspath):
+    """Get the first entry from a route's AS path.
+
+    Only the first entry is checked, the rest of the path (AS sets, an
+    incomplete '?' origin) does not stop the first ASN being returned.
+
+    Args:
+        aspath (str): AS path text from the route entry, e.g. 'AS path: 174 3356 I'
+
+    Returns:
+        str: First ASN in the path, 'I' or '?' if there is no ASN in the path
+             (originated by our ASN) or None if the AS path could not be read.
+    """
+    if aspath is None or not aspath.startswith('AS path: '):
+        return None
+
+    fields = aspath[9:].split(None, 1)
+
+    if not fields:
+        return None
+
+    if fields[0].isdigit() or fields[0] == 'I' or fields[0] == '?':
+        return fields[0]
+
+    return None
 
-    return toList
 
+def open_device(host):
+    """Create a connection to a network device.
 
-def get_routes(host, communities, piSpace=False):
-    """Get routes from a network device.
+    The connection is opened and closed by using the device as a context manager.
 
     Args:
         host (str): Hostname of device
+
+    Returns:
+        Device: Connection to the device
+    """
+    # Imported here as junos-eznc is slow to import and is not needed until we
+    # connect to a device, this keeps --help and config errors fast.
+    #
+    from jnpr.junos import Device  # pylint: disable=import-outside-toplevel
+
+    return Device(host=host, user=cfg['username'], passwd=cfg['password'], transport='ssh', port='22', normalize=True)
+
+
+def fetch_routes(dev, communities, piSpace=False):
+    """Fetch routes from an open network device connection.
+
+    Args:
+        dev (Device): Open connection to the device
         communities (list): Communities to search for
         piSpace (bool, optional): Find PI Space and carve out prefix if
                                   external ASN. Defaults to False.
@@ -52,80 +107,114 @@ def get_routes(host, communities, piSpace=False):
                               and carved prefixes (Not annouced by our ASN.)
     """
     try:
-        with Device(
-            host=host, user=cfg['username'], passwd=cfg['password'], transport='ssh', port='22', normalize=True
-        ) as dev:
-            routesXML = dev.rpc.get_route_information(
-                dev_timeout=60, level='detail', table='inet.0', protocol='bgp', community=communities
-            )
+        routesXML = dev.rpc.get_route_information(
+            dev_timeout=60, level='detail', table='inet.0', protocol='bgp', community=communities
+        )
 
-            prefixSet = IPSet([])
-            carvedSet = IPSet([])
+        # Collect the prefixes as lists and build the IP sets once at the end.
+        #
+        prefixList = []
+        carvedList = []
 
-            routes = routesXML.findall('.//rt')
+        routeCount = 0
 
-            if len(routes) == 0:
-                if verbose_level >= 1:
-                    print("No prefix found with communities: {}".format(str(communities)))
-                return None, None
-
-            # Regex to capture AS Path.
-            #
-            aspathRE = re.compile(r'AS path: ([\d\?I\s]+) [\w\(]')
+        # Walk the routes one at a time, freeing the routes already processed
+        # so the memory used by the response is released as we go.
+        #
+        for _, rt in etree.iterwalk(routesXML, events=('end',), tag='rt'):
+            while rt.getprevious() is not None:
+                del rt.getparent()[0]
 
-            for rt in routes:
-                # print(etree.tounicode(rt, pretty_print=True))
-                prefix = rt.find('.//rt-destination').text
-                prefixLen = rt.find('.//rt-prefix-length').text
-                cidr = prefix + '/' + prefixLen
+            routeCount += 1
 
-                if verbose_level >= 3:
-                    print("Network {} : Mask {}".format(prefix, prefixLen))
+            # print(etree.tounicode(rt, pretty_print=True))
+            prefix = rtDestinationXPath(rt)
+            prefixLen = rtPrefixLengthXPath(rt)
 
-                if int(prefixLen) >= 32:
-                    if verbose_level >= 2:
-                        print("Ignoring PI prefix as /32 host route: {}".format(cidr))
-                    continue
+            if verbose_level >= 3:
+                print("Network {} : Mask {}".format(prefix, prefixLen))
 
-                if piSpace:
-                    # If the CIDR is in our own PA Space but annouced by another ASN we need to carve it out.
-                    #
-                    if cidr in paSpaceSet:
+            # Routes are from inet.0 so /32 is the longest prefix, compare the
+            # string rather than parsing it and only build the CIDR for routes kept.
+            #
+            if prefixLen == '32':
+                if verbose_level >= 2:
+                    print("Ignoring PI prefix as /32 host route: {}/{}".format(prefix, prefixLen))
+                continue
 
-                        aspathMatch = aspathRE.match(rt.find('.//as-path').text)
+            cidr = prefix + '/' + prefixLen
 
-                        if not aspathMatch:
-                            print("ERROR finding match for AS path ({}): {}".format(rt.find('.//as-path').text, cidr))
-                            print(etree.tounicode(rt, pretty_print=True))
-                            continue
+            if piSpace:
+                # If the CIDR is in our own PA Space but annouced by another ASN we need to carve it out.
+                #
+                if paTree.search_best(cidr) is not None:
 
-                        fullaspath = aspathMatch.group(1).split()
+                    aspath = rtASPathXPath(rt)
+                    firstAS = get_first_as(aspath)
 
-                        # Not an internal prefix (our own allocation annoucement) but annouced by external ASN.
-                        #
-                        if fullaspath[0] != 'I' and fullaspath[0] != '?':
-                            carvedSet.add(cidr)
-                            if verbose_level >= 1:
-                                print(
-                                    "Carving out PA space annouced by external ASN ({}): {}".format(
-                                        fullaspath[0], cidr
-                                    )
-                                )
-                            continue
+                    if firstAS is None:
+                        print("ERROR finding match for AS path ({}): {}".format(aspath, cidr))
+                        print(etree.tounicode(rt, pretty_print=True))
+                        continue
 
+                    # Not an internal prefix (our own allocation annoucement) but annouced by external ASN.
+                    #
+                    if firstAS != 'I' and firstAS != '?':
+                        carvedList.append(cidr)
                         if verbose_level >= 1:
-                            print("Ignoring PI prefix as colt space: {}".format(cidr))
+                            print(
+                                "Carving out PA space annouced by external ASN ({}): {}".format(
+                                    firstAS, cidr
+                                )
+                            )
                         continue
 
-                prefixSet.add(cidr)
+                    if verbose_level >= 1:
+                        print("Ignoring PI prefix as colt space: {}".format(cidr))
+                    continue
+
+            prefixList.append(cidr)
 
-            return prefixSet, carvedSet
+        if routeCount == 0:
+            if verbose_level >= 1:
+                print("No prefix found with communities: {}".format(str(communities)))
+            return None, None
+
+        return IPSet(prefixList), IPSet(carvedList)
 
     except Exception as e:
-        print('ERROR: Connecting to {} failed: {}'.format(host, e), file=sys.stderr)
+        print('ERROR: Fetching routes from {} failed: {}'.format(dev.hostname, e), file=sys.stderr)
         return None, None
 
 
+def fetch_city(city, country, device, community):
+    """Fetch the internal and PI routes for a city from its network device.
+
+    Args:
+        city (str): City the routes are for
+        country (str): Country the city is in
+        device (str): Hostname of device
+        community (str): Community tagged on the city's routes
+
+    Returns:
+        tuple (str, IPSet, IPSet, IPSet, IPSet): Returns a tuple with the city, the internal
+                                                 prefixes and carved prefixes followed by the
+                                                 PI prefixes and carved PI prefixes.
+    """
+    if verbose_level >= 1:
+        print("Working on {}, {}, {}".format(city, country, community))
+
+    try:
+        with open_device(device) as dev:
+            prefixSet, carvedSet = fetch_routes(dev, [community, '8220:65404'])
+            piPrefixSet, piCarvedSet = fetch_routes(dev, [community, '8220:65403'], True)
+    except Exception as e:
+        print('ERROR: Connecting to {} failed: {}'.format(device, e), file=sys.stderr)
+        return city, None, None, None, None
+
+    return city, prefixSet, carvedSet, piPrefixSet, piCarvedSet
+
+
 def process_routes(prefixSet, country, city, piSpace=False, carvedSpace=False):
     """Process the routes and allocate them to the cities.
 
@@ -138,16 +227,32 @@ def process_routes(prefixSet, country, city, piSpace=False, carvedSpace=False):
     """
     global cities
 
+    # Collect the changes as lists and merge them into the cities IP sets once
+    # at the end rather than adding each CIDR one at a time.
+    #
+    exclude = {}
+    additions = []
+    carved = []
+    newSpace = []
+
     # Check if CIDR is in the cities lists
     for cidr in prefixSet.iter_cidrs():
 
+        # Find the city allocation the CIDR falls in, if any. The lookup uses the
+        # packed network address to save formatting and reparsing the CIDR string.
+        #
+        packed = cidr.value.to_bytes(4 if cidr.version == 4 else 16, 'big')
+        node = cityTree.search_best(packed=packed, masklen=cidr.prefixlen)
+
+        owner = node.data['cities'][0] if node is not None else None
+
         # Check if the CIDR is in the allocation for the country
         #
-        if cidr in cities[city]['base']:
+        if owner == city:
             # In the correct City allocation but annouced by external ASN.
             if carvedSpace:
-                cities[city]['exclude'].add(cidr)
-                cities[city]['carvedSpace'].add(cidr)
+                exclude.setdefault(city, []).append(cidr)
+                carved.append(cidr)
                 if verbose_level >= 1:
                     print(
                         "{} belongs to correct city allocation but annouced by external ASN: {}, {}".format(
@@ -161,30 +266,36 @@ def process_routes(prefixSet, country, city, piSpace=False, carvedSpace=False):
 
         # The range has come out of another countries allocation, find it and add to city
         #
-        foundSupernet = False
-        for snCity in cities:
-            if cidr in cities[snCity]['base']:
-                foundSupernet = True
-                cities[snCity]['exclude'].add(cidr)
-                # In different city but annnouced by an external ASN.
-                if carvedSpace:
-                    cities[city]['carvedSpace'].add(cidr)
-                    if verbose_level >= 1:
-                        print("Moving {} announced by an external ASN from {} to {}.".format(cidr, snCity, city))
-                else:
-                    cities[city]['additions'].add(cidr)
-                    if verbose_level >= 2:
-                        print("Moving {} from {} to {}.".format(cidr, snCity, city))
-                break
+        if owner is not None:
+            snCity = owner
+            exclude.setdefault(snCity, []).append(cidr)
+            # In different city but annnouced by an external ASN.
+            if carvedSpace:
+                carved.append(cidr)
+                if verbose_level >= 1:
+                    print("Moving {} announced by an external ASN from {} to {}.".format(cidr, snCity, city))
+            else:
+                additions.append(cidr)
+                if verbose_level >= 2:
+                    print("Moving {} from {} to {}.".format(cidr, snCity, city))
+            continue
 
         # This block did not belong to any existing allocation, create new one.
-        if not foundSupernet:
-            if verbose_level >= 2:
-                print("{} is a small allocation or PI range adding to city {} allocation.".format(cidr, city))
-            if piSpace:
-                cities[city]['piSpace'].add(cidr)
-            else:
-                cities[city]['smallpiSpace'].add(cidr)
+        if verbose_level >= 2:
+            print("{} is a small allocation or PI range adding to city {} allocation.".format(cidr, city))
+        newSpace.append(cidr)
+
+    for exCity in exclude:
+        cities[exCity]['exclude'].update(exclude[exCity])
+
+    cityData = cities[city]
+    cityData['additions'].update(additions)
+    cityData['carvedSpace'].update(carved)
+
+    if piSpace:
+        cityData['piSpace'].update(newSpace)
+    else:
+        cityData['smallpiSpace'].update(newSpace)
 
 
 @click.command()
@@ -205,239 +316,297 @@ def process_routes(prefixSet, country, city, piSpace=False, carvedSpace=False):
     default="iplocdata",
     help="The base name for the output file, csv and json extensions will be added automatically."
 )
-def cli(config, verbose, outfile):
+@click.option(
+    "-w",
+    "--workers",
+    default=10,
+    type=click.IntRange(min=1),
+    help="Number of devices to fetch routes from in parallel."
+)
+def cli(config, verbose, outfile, workers):
     """Entry point for command."""
     # Allow acces to cfg and verbose_level vars
     #
     global cfg
     global verbose_level
-    global paSpaceSet
 
     verbose_level = verbose
     cfg = json.load(config)
 
     # First convert all the cities
     #
-    for city in cfg['cities']:
+    for city, cityCfg in cfg['cities'].items():
         if city not in cities:
             cities[city] = {
                 'base': None,
                 'additions': IPSet([]),
                 'exclude': IPSet([]),
-                'country': cfg['cities'][city]['country'],
+                'country': cityCfg['country'],
                 'piSpace': IPSet([]),
                 'smallpiSpace': IPSet([]),
                 'carvedSpace': IPSet([])
             }
 
-        if 'override' in cfg['cities'][city]:
-            cities[city]['override'] = IPSet(cfg['cities'][city]['override'])
+        cityData = cities[city]
+
+        if 'override' in cityCfg:
+            cityData['override'] = IPSet(cityCfg['override'])
         else:
-            cities[city]['override'] = IPSet([])
+            cityData['override'] = IPSet([])
 
-        if 'community' in cfg['cities'][city]:
-            cities[city]['community'] = cfg['cities'][city]['community']
+        if 'community' in cityCfg:
+            cityData['community'] = cityCfg['community']
 
-        if 'device' in cfg['cities'][city]:
-            cities[city]['device'] = cfg['cities'][city]['device']
+        if 'device' in cityCfg:
+            cityData['device'] = cityCfg['device']
 
-        if 'region' in cfg['cities'][city]:
-            cities[city]['region'] = cfg['cities'][city]['region']
+        if 'region' in cityCfg:
+            cityData['region'] = cityCfg['region']
         else:
-            cities[city]['region'] = ""
+            cityData['region'] = ""
 
-        cities[city]['base'] = IPSet(cfg['cities'][city]['cidrs'])
+        cityData['base'] = IPSet(cityCfg['cidrs'])
 
     # Free up some memory here we don't need the cities in the cfg now.
     #
     del cfg['cities']
 
-    # Check there are no overlapping address space
+    # Index the base allocations, checking there are no overlapping address space
+    # against the ones already indexed as each is added.
     #
     hasError = False
-    for city in cities:
-        for cidr in cities[city]['base'].iter_cidrs():
-            for checkCity in cities:
-                if checkCity == city:
-                    continue
-                if cidr in cities[checkCity]['base']:
-                    print("ERROR: Overlapping cidr {} from {} found in {}.".format(cidr, city, checkCity))
-                    hasError = True
+    for city, cityData in cities.items():
+        for cidr in cityData['base'].iter_cidrs():
+            prefix = str(cidr)
+
+            # An exact match is returned by both searches, keep each
+            # conflicting prefix and city once.
+            #
+            overlaps = {}
+            for node in cityTree.search_covering(prefix) + cityTree.search_covered(prefix):
+                for checkCity in node.data['cities']:
+                    if checkCity != city:
+                        overlaps[(node.prefix, checkCity)] = True
+
+            for overlapPrefix, checkCity in overlaps:
+                print(
+                    "ERROR: Overlapping cidr {} from {} overlaps {} in {}.".format(cidr, city, overlapPrefix, checkCity)
+                )
+                hasError = True
+
+            # Keep every owner of a prefix listed in more than one city so later
+            # overlaps are reported against all of them.
+            #
+            node = cityTree.add(prefix)
+            node.data.setdefault('cities', []).append(city)
 
     if hasError:
         sys.exit()
 
-    # Now convert the PA Space
+    # Now convert the PA Space, merging it first so a route spanning adjacent
+    # PA prefixes is still found in the tree.
+
+    for paPrefix in IPSet(cfg['paspace']).iter_cidrs():
+        paTree.add(str(paPrefix))
 
-    for paPrefix in cfg['paspace']:
-        paSpaceSet.add(paPrefix)
+    fetchCities = []
 
-    for city in cities:
+    for city, cityData in cities.items():
 
         # Skip if community or device is missing or empty
         #
-        if 'community' not in cities[city]:
+        if 'community' not in cityData:
             continue
 
-        if 'device' not in cities[city]:
+        if 'device' not in cityData:
             continue
 
-        if not cities[city]['community']:
+        if not cityData['community']:
             continue
 
-        if not cities[city]['device']:
+        if not cityData['device']:
             continue
 
-        country = cities[city]['country']
-        community = cities[city]['community']
-        device = cities[city]['device']
+        fetchCities.append(city)
 
-        if verbose_level >= 1:
-            print("Working on {}, {}, {}".format(city, country, community))
+    # Fetch routes from the devices in parallel, processing is kept on this
+    # thread so only it writes to the cities.
+    #
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for city in fetchCities:
+            cityData = cities[city]
+            futures.append(
+                executor.submit(fetch_city, city, cityData['country'], cityData['device'], cityData['community'])
+            )
 
-        # Get internal and small prefix routes.
-        #
-        prefixSet, carvedSet = get_routes(device, [community, '8220:65404'])
+        for future in as_completed(futures):
+            city, prefixSet, carvedSet, piPrefixSet, piCarvedSet = future.result()
+            country = cities[city]['country']
 
-        # prefixSet contains our allocation address space, add it to the correct country.
-        #
-        if prefixSet is not None:
-            process_routes(prefixSet, country, city)
-
-        # This should never fire off.
-        #
-        if carvedSet is not None:
-            process_routes(carvedSet, country, city, False, True)
+            # prefixSet contains our allocation address space, add it to the correct country.
+            #
+            if prefixSet is not None:
+                process_routes(prefixSet, country, city)
 
-        # Get any prefixes annouced by external ASN.
-        #
-        prefixSet, carvedSet = get_routes(device, [community, '8220:65403'], True)
+            # This should never fire off.
+            #
+            if carvedSet is not None:
+                process_routes(carvedSet, country, city, False, True)
 
-        # prefixSet contains all PI space annoucements.
-        if prefixSet is not None:
-            process_routes(prefixSet, country, city, True)
+            # piPrefixSet contains all PI space annoucements.
+            if piPrefixSet is not None:
+                process_routes(piPrefixSet, country, city, True)
 
-        # carvedSet are routes advertised by another ASN but from our own allocation.
-        # Add them to the correct country but in the carvedSet.
-        #
-        if carvedSet is not None:
-            process_routes(carvedSet, country, city, True, True)
+            # piCarvedSet are routes advertised by another ASN but from our own allocation.
+            # Add them to the correct country but in the carvedSet.
+            #
+            if piCarvedSet is not None:
+                process_routes(piCarvedSet, country, city, True, True)
 
     # Check there are no overlapping PI address space
     #
     smallPISpace = IPSet([])
-    for city in cities:
-        smallPISpace = smallPISpace | cities[city]['smallpiSpace']
-
-    for city in cities:
-        for smallcidr in smallPISpace.iter_cidrs():
-            for cidr in cities[city]['piSpace'].iter_cidrs():
-                if smallcidr in cidr:
-                    if verbose_level >= 2:
-                        print(
-                            "Removing duplicate (containing) PI cidr from {}: {} contains {}.".format(
-                                city, cidr, smallcidr
-                            )
+    for cityData in cities.values():
+        smallPISpace = smallPISpace | cityData['smallpiSpace']
+
+    smallPITree = radix.Radix()
+    for smallcidr in smallPISpace.iter_cidrs():
+        smallPITree.add(str(smallcidr))
+
+    for city, cityData in cities.items():
+        duplicates = []
+        for cidr in cityData['piSpace'].iter_cidrs():
+            smallNodes = smallPITree.search_covered(str(cidr))
+            if smallNodes:
+                if verbose_level >= 2:
+                    print(
+                        "Removing duplicate (containing) PI cidr from {}: {} contains {}.".format(
+                            city, cidr, smallNodes[0].prefix
                         )
-                    cities[city]['piSpace'].remove(cidr)
-                    break
+                    )
+                duplicates.append(cidr)
+
+        for cidr in duplicates:
+            cityData['piSpace'].remove(cidr)
 
     del smallPISpace
+    del smallPITree
 
     # pp.pprint(cities)
 
-    # Consolidate the results and do the removals and adds.
+    # Consolidate the results and do the removals and adds. The adds update
+    # the sets in place rather than building a new set for each union.
     #
-    for city in cities:
-        cities[city]['base'] = cities[city]['base'] | cities[city]['additions']
-        cities[city]['base'] = cities[city]['base'] - cities[city]['exclude']
-        cities[city]['base'] = cities[city]['base'] | cities[city]['override']
-        cities[city]['piSpace'] = cities[city]['piSpace'] | cities[city]['smallpiSpace'] | cities[city]['carvedSpace']
-
-        del cities[city]['additions']
-        del cities[city]['exclude']
-        del cities[city]['smallpiSpace']
-        del cities[city]['carvedSpace']
-
-        if 'community' in cities[city]:
-            del cities[city]['community']
-
-        if 'device' in cities[city]:
-            del cities[city]['device']
+    for cityData in cities.values():
+        cityData['base'].update(cityData['additions'])
+        cityData['base'] = cityData['base'] - cityData['exclude']
+        cityData['base'].update(cityData['override'])
+        cityData['piSpace'].update(cityData['smallpiSpace'])
+        cityData['piSpace'].update(cityData['carvedSpace'])
+
+        del cityData['additions']
+        del cityData['exclude']
+        del cityData['smallpiSpace']
+        del cityData['carvedSpace']
+
+        if 'community' in cityData:
+            del cityData['community']
+
+        if 'device' in cityData:
+            del cityData['device']
+
+    # Index the cities allocations so the cities holding an override can be
+    # looked up directly.
+    #
+    spaceTree = radix.Radix()
+    for city, cityData in cities.items():
+        for space in ('base', 'piSpace'):
+            for cidr in cityData[space].iter_cidrs():
+                node = spaceTree.add(str(cidr))
+                node.data.setdefault(space, []).append(city)
 
     # Remove the override from the other cities
     #
-    for city in cities:
-        for cidr in cities[city]['override'].iter_cidrs():
-            for checkCity in cities:
-                if checkCity == city:
-                    continue
-                if cidr in cities[checkCity]['base']:
-                    if verbose_level >= 1:
-                        print("Overridden cidr {} from {} found in {}.".format(cidr, city, checkCity))
-                    cities[checkCity]['base'].remove(cidr)
-                if cidr in cities[checkCity]['piSpace']:
-                    if verbose_level >= 1:
-                        print("Overridden cidr {} from {} found in {}.".format(cidr, city, checkCity))
-                    cities[checkCity]['piSpace'].remove(cidr)
+    for city, cityData in cities.items():
+        for cidr in cityData['override'].iter_cidrs():
+            for node in spaceTree.search_covering(str(cidr)):
+                for space in ('base', 'piSpace'):
+                    for checkCity in node.data.get(space, []):
+                        if checkCity == city:
+                            continue
+                        checkSpace = cities[checkCity][space]
+                        if cidr in checkSpace:
+                            if verbose_level >= 1:
+                                print("Overridden cidr {} from {} found in {}.".format(cidr, city, checkCity))
+                            checkSpace.remove(cidr)
 
-        del cities[city]['override']
+        del cityData['override']
 
-    # Convert for json output
+    # Convert for json output, keeping the combined base and PI space for
+    # the PI csv file.
     #
-    for city in cities:
-        cities[city]['cidrs'] = ipset_to_list(cities[city]['base'])
-        del cities[city]['base']
+    csvPICidrs = {}
+
+    for city, cityData in cities.items():
+        csvPICidrs[city] = ipset_to_list(cityData['base'] | cityData['piSpace'])
+
+        cityData['cidrs'] = ipset_to_list(cityData['base'])
+        del cityData['base']
 
-        cities[city]['piCidrs'] = ipset_to_list(cities[city]['piSpace'])
-        del cities[city]['piSpace']
+        cityData['piCidrs'] = ipset_to_list(cityData['piSpace'])
+        del cityData['piSpace']
 
     # Open the output files
     #
-    csvFile = open(outfile + '.csv', 'w')
-    csvPIFile = open(outfile + '_pi.csv', 'w')
-    jsonFile = open(outfile + '.json', 'w')
-    jsonFileCountry = open(outfile + '_country.json', 'w')
+    csvFile = open(outfile + '.csv', 'w', buffering=1 << 20)
+    csvPIFile = open(outfile + '_pi.csv', 'w', buffering=1 << 20)
+    jsonFile = open(outfile + '.json', 'wb')
+    jsonFileCountry = open(outfile + '_country.json', 'wb')
 
     # Output json file with full structure
     #
-    json.dump(cities, jsonFile, sort_keys=True, indent=4)
+    jsonFile.write(orjson.dumps(cities, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
 
     #
     # Google Feed format: ip_range,country,region,city,postal_code
     #
-    csvFormat = "{},{},{},{},"
-
-    for city in cities:
-        for cidrOut in cities[city]['cidrs']:
-            print(csvFormat.format(cidrOut, cities[city]['country'], cities[city]['region'], city), file=csvFile)
-
-    for city in cities:
-        cidrSet = IPSet(cities[city]['cidrs']) | IPSet(cities[city]['piCidrs'])
-        for cidrOut in cidrSet.iter_cidrs():
-            print(csvFormat.format(str(cidrOut), cities[city]['country'], cities[city]['region'], city), file=csvPIFile)
+    csvFile.writelines(
+        f"{cidrOut},{cityData['country']},{cityData['region']},{city},\n"
+        for city, cityData in cities.items()
+        for cidrOut in cityData['cidrs']
+    )
+
+    csvPIFile.writelines(
+        f"{cidrOut},{cityData['country']},{cityData['region']},{city},\n"
+        for city, cityData in cities.items()
+        for cidrOut in csvPICidrs[city]
+    )
 
     # Output the data based on coutry rather than city.
 
-    countries = {}
+    # Collect the city lists for each country first so each country is merged
+    # into an IP set once.
+    #
+    countryCidrs = {}
 
-    for city in cities:
-        country = cities[city]['country']
-        if country not in countries:
-            countries[country] = {'cidrs': IPSet(cities[city]['cidrs']), 'piCidrs': IPSet(cities[city]['piCidrs'])}
-        else:
-            countries[country]['cidrs'] = countries[country]['cidrs'] | IPSet(cities[city]['cidrs'])
-            countries[country]['piCidrs'] = countries[country]['piCidrs'] | IPSet(cities[city]['piCidrs'])
+    for cityData in cities.values():
+        cidrs, piCidrs = countryCidrs.setdefault(cityData['country'], ([], []))
+        cidrs.extend(cityData['cidrs'])
+        piCidrs.extend(cityData['piCidrs'])
 
     # Convert country object to lists for Json output.
     #
-    for country in countries:
-        countries[country]['cidrs'] = ipset_to_list(countries[country]['cidrs'])
-        countries[country]['piCidrs'] = ipset_to_list(countries[country]['piCidrs'])
+    countries = {}
+
+    for country, (cidrs, piCidrs) in countryCidrs.items():
+        countries[country] = {'cidrs': ipset_to_list(IPSet(cidrs)), 'piCidrs': ipset_to_list(IPSet(piCidrs))}
+
+    del countryCidrs
 
     # Output countries json file with full structure
     #
-    json.dump(countries, jsonFileCountry, sort_keys=True, indent=4)
+    jsonFileCountry.write(orjson.dumps(countries, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
 
     # Close all the files
     #
@@ -450,3 +619,7 @@ def cli(config, verbose, outfile):
     csvPIFile.close()
     jsonFile.close()
     jsonFileCountry.close()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,257 @@
+import json
+
+import pytest
+import radix
+
+from click.testing import CliRunner
+from lxml import etree
+from netaddr import IPSet
+
+from iplocbuild import cli
+
+
+@pytest.fixture
+def cities(monkeypatch):
+    """Two cities with their base allocations indexed in the city tree."""
+    cities = {}
+    cityTree = radix.Radix()
+
+    for city, country, cidr in (('London', 'GB', '10.0.0.0/16'), ('Paris', 'FR', '10.1.0.0/16')):
+        cities[city] = {
+            'base': IPSet([cidr]),
+            'additions': IPSet([]),
+            'exclude': IPSet([]),
+            'country': country,
+            'piSpace': IPSet([]),
+            'smallpiSpace': IPSet([]),
+            'carvedSpace': IPSet([])
+        }
+        cityTree.add(cidr).data['cities'] = [city]
+
+    monkeypatch.setattr(cli, 'cities', cities)
+    monkeypatch.setattr(cli, 'cityTree', cityTree)
+
+    return cities
+
+
+def assert_spaces(cityData, **expected):
+    """Check each working IP set of a city, sets not given must be empty."""
+    for space in ('additions', 'exclude', 'piSpace', 'smallpiSpace', 'carvedSpace'):
+        assert cityData[space] == IPSet(expected.get(space, [])), space
+
+
+def test_process_routes_same_city(cities):
+    cli.process_routes(IPSet(['10.0.1.0/24']), 'GB', 'London')
+
+    assert_spaces(cities['London'])
+    assert_spaces(cities['Paris'])
+
+
+def test_process_routes_same_city_carved(cities):
+    cli.process_routes(IPSet(['10.0.1.0/24']), 'GB', 'London', True, True)
+
+    assert_spaces(cities['London'], exclude=['10.0.1.0/24'], carvedSpace=['10.0.1.0/24'])
+    assert_spaces(cities['Paris'])
+
+
+def test_process_routes_moved(cities):
+    cli.process_routes(IPSet(['10.1.2.0/24']), 'GB', 'London')
+
+    assert_spaces(cities['London'], additions=['10.1.2.0/24'])
+    assert_spaces(cities['Paris'], exclude=['10.1.2.0/24'])
+
+
+def test_process_routes_moved_carved(cities):
+    cli.process_routes(IPSet(['10.1.2.0/24']), 'GB', 'London', True, True)
+
+    assert_spaces(cities['London'], carvedSpace=['10.1.2.0/24'])
+    assert_spaces(cities['Paris'], exclude=['10.1.2.0/24'])
+
+
+@pytest.mark.parametrize('cidr', ['192.168.0.0/24', '10.0.0.0/15', '2001:db8::/32'])
+def test_process_routes_unallocated(cities, cidr):
+    cli.process_routes(IPSet([cidr]), 'GB', 'London')
+
+    assert_spaces(cities['London'], smallpiSpace=[cidr])
+    assert_spaces(cities['Paris'])
+
+
+def test_process_routes_unallocated_pi(cities):
+    cli.process_routes(IPSet(['192.168.0.0/24']), 'GB', 'London', True)
+
+    assert_spaces(cities['London'], piSpace=['192.168.0.0/24'])
+    assert_spaces(cities['Paris'])
+
+
+@pytest.mark.parametrize(
+    'aspath, expected',
+    [
+        ('AS path: 174 3356 I', '174'),
+        ('AS path: I', 'I'),
+        ('AS path: ?', '?'),
+        ('AS path: 65001 ?', '65001'),
+        ('AS path: 174 {3356} I', '174'),
+        ('AS path: [65000] 1 I', None),
+        ('', None),
+        (None, None),
+    ]
+)
+def test_get_first_as(aspath, expected):
+    assert cli.get_first_as(aspath) == expected
+
+
+@pytest.fixture
+def run_cli(monkeypatch, tmp_path):
+    """Run the command with cities that have no devices, so no routes are fetched."""
+    monkeypatch.setattr(cli, 'cities', {})
+    monkeypatch.setattr(cli, 'cityTree', radix.Radix())
+    monkeypatch.setattr(cli, 'paTree', radix.Radix())
+
+    def run(cities):
+        config = tmp_path / 'config.json'
+        config.write_text(json.dumps({'username': 'user', 'password': 'pass', 'paspace': [], 'cities': cities}))
+        return CliRunner().invoke(cli.cli, ['--config', str(config), '-o', str(tmp_path / 'out')])
+
+    return run
+
+
+@pytest.mark.parametrize(
+    'cities, errors',
+    [
+        (
+            {
+                'a': {'country': 'GB', 'cidrs': ['10.0.0.0/24', '10.0.1.0/24']},
+                'b': {'country': 'GB', 'cidrs': ['10.0.0.0/23']},
+                'c': {'country': 'GB', 'cidrs': ['10.0.0.128/25']},
+            },
+            [
+                'ERROR: Overlapping cidr 10.0.0.0/23 from b overlaps 10.0.0.0/23 in a.',
+                'ERROR: Overlapping cidr 10.0.0.128/25 from c overlaps 10.0.0.0/23 in a.',
+                'ERROR: Overlapping cidr 10.0.0.128/25 from c overlaps 10.0.0.0/23 in b.',
+            ]
+        ),
+        (
+            {
+                'a': {'country': 'GB', 'cidrs': ['10.0.0.0/24']},
+                'b': {'country': 'FR', 'cidrs': ['10.0.0.0/24']},
+            },
+            ['ERROR: Overlapping cidr 10.0.0.0/24 from b overlaps 10.0.0.0/24 in a.']
+        ),
+        (
+            {
+                'a': {'country': 'GB', 'cidrs': ['10.0.0.0/16']},
+                'b': {'country': 'GB', 'cidrs': ['10.0.1.0/24', '10.0.4.0/24']},
+            },
+            [
+                'ERROR: Overlapping cidr 10.0.1.0/24 from b overlaps 10.0.0.0/16 in a.',
+                'ERROR: Overlapping cidr 10.0.4.0/24 from b overlaps 10.0.0.0/16 in a.',
+            ]
+        ),
+        (
+            {
+                'b': {'country': 'GB', 'cidrs': ['10.0.1.0/24', '10.0.4.0/24']},
+                'a': {'country': 'GB', 'cidrs': ['10.0.0.0/16']},
+            },
+            [
+                'ERROR: Overlapping cidr 10.0.0.0/16 from a overlaps 10.0.1.0/24 in b.',
+                'ERROR: Overlapping cidr 10.0.0.0/16 from a overlaps 10.0.4.0/24 in b.',
+            ]
+        ),
+    ]
+)
+def test_cli_overlapping_cities(run_cli, tmp_path, cities, errors):
+    result = run_cli(cities)
+
+    assert result.output.splitlines() == errors
+    assert not (tmp_path / 'out.json').exists()
+
+
+def test_cli_override_removed_from_other_cities(run_cli, tmp_path):
+    result = run_cli(
+        {
+            'a': {'country': 'GB', 'cidrs': ['10.0.0.0/16']},
+            'b': {'country': 'GB', 'cidrs': ['10.1.0.0/16'], 'override': ['10.0.1.0/24']},
+            'c': {'country': 'GB', 'cidrs': ['10.2.0.0/16'], 'override': ['10.0.1.0/25']},
+            'd': {'country': 'GB', 'cidrs': ['10.3.0.0/16'], 'override': ['10.0.2.0/24']},
+        }
+    )
+
+    assert result.exit_code == 0
+
+    # c's override falls in the range b has already taken from a, so it is
+    # removed from b and a is left as split by b and d.
+    #
+    output = json.loads((tmp_path / 'out.json').read_text())
+
+    assert IPSet(output['a']['cidrs']) == IPSet(['10.0.0.0/16']) - IPSet(['10.0.1.0/24', '10.0.2.0/24'])
+    assert output['b']['cidrs'] == ['10.0.1.128/25', '10.1.0.0/16']
+    assert output['c']['cidrs'] == ['10.0.1.0/25', '10.2.0.0/16']
+    assert output['d']['cidrs'] == ['10.0.2.0/24', '10.3.0.0/16']
+
+
+class StubDevice:
+    """Device stand in returning a fixed route RPC reply."""
+
+    hostname = 'router1'
+
+    def __init__(self, reply):
+        self.rpc = self
+        self.reply = reply
+        self.calls = []
+
+    def get_route_information(self, **kwargs):
+        self.calls.append(kwargs)
+        return etree.fromstring(self.reply)
+
+
+def route_xml(prefix, prefixLen, aspath):
+    return (
+        '<rt><rt-destination>{}</rt-destination><rt-prefix-length>{}</rt-prefix-length>'
+        '<rt-entry-count>1</rt-entry-count><rt-entry><as-path>{}</as-path></rt-entry></rt>'
+    ).format(prefix, prefixLen, aspath)
+
+
+ROUTES_REPLY = (
+    '<route-information><route-table><table-name>inet.0</table-name><total-route-count>5</total-route-count>'
+    + route_xml('10.1.1.1', '32', 'AS path: I (Originator)')
+    + route_xml('10.2.0.0', '24', 'AS path: 65001 I (Originator)')
+    + route_xml('10.3.0.0', '24', 'AS path: I (Originator)')
+    + '</route-table><route-table><table-name>inet.0</table-name>'
+    + route_xml('192.168.0.0', '24', 'AS path: 65002 I (Originator)')
+    + route_xml('10.4.0.0', '24', 'AS path: I (Originator)')
+    + '</route-table></route-information>'
+)
+
+
+@pytest.fixture
+def paTree(monkeypatch):
+    paTree = radix.Radix()
+    paTree.add('10.0.0.0/8')
+    monkeypatch.setattr(cli, 'paTree', paTree)
+    return paTree
+
+
+def test_fetch_routes(paTree):
+    dev = StubDevice(ROUTES_REPLY)
+
+    prefixSet, carvedSet = cli.fetch_routes(dev, ['65000:1', '8220:65404'])
+
+    assert prefixSet == IPSet(['10.2.0.0/24', '10.3.0.0/24', '10.4.0.0/24', '192.168.0.0/24'])
+    assert carvedSet == IPSet([])
+    assert dev.calls[0]['community'] == ['65000:1', '8220:65404']
+
+
+def test_fetch_routes_pi_space(paTree):
+    prefixSet, carvedSet = cli.fetch_routes(StubDevice(ROUTES_REPLY), ['65000:1', '8220:65403'], True)
+
+    # The /32 is skipped, PA space announced externally is carved and PA
+    # space originated internally is ignored.
+    #
+    assert prefixSet == IPSet(['192.168.0.0/24'])
+    assert carvedSet == IPSet(['10.2.0.0/24'])
+
+
+def test_fetch_routes_empty(paTree):
+    reply = '<route-information><route-table><table-name>inet.0</table-name></route-table></route-information>'
+
+    assert cli.fetch_routes(StubDevice(reply), ['65000:1', '8220:65404']) == (None, None)